@@ -8,6 +8,8 @@
 ###########################################################################
 """Tests to run with a running daemon."""
 
+import asyncio
+import functools
 import os
 import re
 import shutil
@@ -29,13 +31,29 @@ from workchains import (
     WorkFunctionRunnerWorkChain,
 )
 
+from aiida.cmdline.utils.common import get_calcjob_report, get_process_function_report, get_workchain_report
 from aiida.common import StashMode, exceptions
-from aiida.engine import run, submit
+from aiida.engine import ProcessFuture, ProcessState, run, submit
 from aiida.engine.daemon.client import get_daemon_client
 from aiida.engine.persistence import ObjectLoader
 from aiida.engine.processes import CalcJob, Process
+from aiida.manage import get_manager
 from aiida.manage.caching import enable_caching
-from aiida.orm import CalcJobNode, Dict, Int, List, Str, load_code, load_node
+from aiida.orm import (
+    CalcFunctionNode,
+    CalcJobNode,
+    Data,
+    Dict,
+    Int,
+    List,
+    ProcessNode,
+    QueryBuilder,
+    Str,
+    WorkChainNode,
+    WorkFunctionNode,
+    load_code,
+    load_node,
+)
 from aiida.orm.nodes.caching import NodeCaching
 from aiida.plugins import CalculationFactory, WorkflowFactory
 from aiida.workflows.arithmetic.add_multiply import add, add_multiply
@@ -46,6 +64,12 @@ CODENAME_DOUBLER = 'doubler@localhost'
 TIMEOUTSECS = 4 * 60  # 4 minutes
 NUMBER_CALCULATIONS = 15  # Number of calculations to submit
 NUMBER_WORKCHAINS = 8  # Number of workchains to submit
+REPORT_INTERVAL = 15  # Interval in seconds between printing progress while waiting for the processes
+DEBUG_INTERVAL = 60  # Minimum interval in seconds between starting the debug commands
+DEBUG_COMMANDS = (['verdi', 'process', 'list', '-a'], ['verdi', 'daemon', 'status'])
+
+TemplatereplacerCalculation = CalculationFactory('core.templatereplacer')
+TERMINAL_PROCESS_STATES = (ProcessState.FINISHED.value, ProcessState.KILLED.value, ProcessState.EXCEPTED.value)
 
 
 def print_daemon_log():
@@ -53,43 +77,64 @@ def print_daemon_log():
     daemon_client = get_daemon_client()
     daemon_log = daemon_client.daemon_log_file
 
-    print(f"Output of 'cat {daemon_log}':")
+    print(f"Content of '{daemon_log}':")
     try:
-        print(
-            subprocess.check_output(
-                ['cat', f'{daemon_log}'],
-                stderr=subprocess.STDOUT,
-            )
-        )
-    except subprocess.CalledProcessError as exception:
-        print(f'Note: the command failed, message: {exception}')
+        with open(daemon_log, 'rb') as handle:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(handle.read())
+            sys.stdout.flush()
+    except OSError as exception:
+        print(f'Note: reading the file failed, message: {exception}')
 
 
-def jobs_have_finished(pks):
-    """Check if jobs with given pks have finished."""
-    finished_list = [load_node(pk).is_terminated for pk in pks]
-    node_list = [load_node(pk) for pk in pks]
-    num_finished = len([_ for _ in finished_list if _])
+def jobs_have_finished(pks, terminated):
+    """Check if jobs with given pks have finished.
 
-    for node in node_list:
-        if not node.is_terminated:
-            print(f'not terminated: {node.pk} [{node.process_state}]')
-    print(f'{num_finished}/{len(finished_list)} finished')
-    return False not in finished_list
+    The process states of all nodes are fetched with a single query instead of loading each node individually.
+
+    :param pks: the pks of the processes to check.
+    :param terminated: set of pks that are known to have terminated, which are therefore no longer queried. Any pk
+        that is found to have terminated is added to it. Passing the same set on every call means that each call only
+        queries the processes that were still running at the previous one.
+    :return: True if all processes have terminated, False otherwise.
+    """
+    pending = [pk for pk in pks if pk not in terminated]
+    process_states = {}
+
+    if pending:
+        query = QueryBuilder().append(
+            ProcessNode, filters={'id': {'in': pending}}, project=['id', 'attributes.process_state']
+        )
+        process_states = dict(query.all(batch_size=len(pending)))
+        terminated.update(pk for pk, state in process_states.items() if state in TERMINAL_PROCESS_STATES)
+
+    num_finished = 0
+    for pk in pks:
+        if pk in terminated:
+            num_finished += 1
+        else:
+            print(f'not terminated: {pk} [{process_states.get(pk)}]')
+    print(f'{num_finished}/{len(pks)} finished')
+    return num_finished == len(pks)
 
 
 def print_report(pk):
-    """Print the process report for given pk."""
-    print(f"Output of 'verdi process report {pk}':")
+    """Print the process report for given pk, as ``verdi process report`` would."""
+    print(f'Report of process<{pk}>:')
     try:
-        print(
-            subprocess.check_output(
-                ['verdi', 'process', 'report', f'{pk}'],
-                stderr=subprocess.STDOUT,
-            )
-        )
-    except subprocess.CalledProcessError as exception:
-        print(f'Note: the command failed, message: {exception}')
+        node = load_node(pk)
+    except exceptions.NotExistent as exception:
+        print(f'Note: loading the process failed, message: {exception}')
+        return
+
+    if isinstance(node, CalcJobNode):
+        print(get_calcjob_report(node))
+    elif isinstance(node, WorkChainNode):
+        print(get_workchain_report(node, levelname='REPORT', indent_size=2))
+    elif isinstance(node, (CalcFunctionNode, WorkFunctionNode)):
+        print(get_process_function_report(node))
+    else:
+        print(f'Nothing to show for node type {node.__class__}')
 
 
 def validate_process_functions(expected_results):
@@ -116,23 +161,50 @@ def validate_process_functions(expected_results):
     return valid
 
 
+def get_processes_and_outputs(pks, link_label):
+    """Return the process nodes with the given pks together with their output with the given link label.
+
+    The processes and their outputs are fetched with a single query, instead of loading each process and then querying
+    for its outputs. Only processes that lack the output require an additional query.
+
+    :param pks: the pks of the processes.
+    :param link_label: the link label of the output.
+    :return: dictionary mapping the pk of each existing process onto a tuple of its node and output node, where the
+        latter is ``None`` if the process does not have the output.
+    """
+    query = (
+        QueryBuilder()
+        .append(ProcessNode, tag='process', filters={'id': {'in': pks}}, project=['*'])
+        .append(Data, with_incoming='process', edge_filters={'label': link_label}, project=['*'])
+    )
+    results = {process.pk: (process, output) for process, output in query.all()}
+    missing = [pk for pk in pks if pk not in results]
+
+    if missing:
+        query = QueryBuilder().append(ProcessNode, filters={'id': {'in': missing}})
+        results.update({process.pk: (process, None) for process in query.all(flat=True)})
+
+    return results
+
+
 def validate_calculations(expected_results):
     """Validate the calculations."""
     valid = True
     actual_dict = {}
+    processes = get_processes_and_outputs(list(expected_results), 'output_parameters')
     for pk, expected_dict in expected_results.items():
-        calc = load_node(pk)
+        calc, output_parameters = processes[pk]
         if not calc.is_finished_ok:
             print(f'Calc<{pk}> not finished ok: process_state<{calc.process_state}> exit_status<{calc.exit_status}>')
             print_report(pk)
             valid = False
 
-        try:
-            actual_dict = calc.outputs.output_parameters.get_dict()
-        except exceptions.NotExistent:
+        if output_parameters is None:
             print(f'Could not retrieve `output_parameters` node for Calculation<{pk}>')
             print_report(pk)
             valid = False
+        else:
+            actual_dict = output_parameters.get_dict()
 
         try:
             actual_dict['retrieved_temporary_files'] = dict(actual_dict['retrieved_temporary_files'])
@@ -156,20 +228,15 @@ def validate_calculations(expected_results):
 def validate_workchains(expected_results):
     """Validate the workchains."""
     valid = True
+    processes = get_processes_and_outputs(list(expected_results), 'output')
     for pk, expected_value in expected_results.items():
         this_valid = True
-        try:
-            calc = load_node(pk)
-            actual_value = calc.outputs.output
-        except (exceptions.NotExistent, AttributeError) as exception:
-            print(
-                '* UNABLE TO RETRIEVE VALUE for workchain pk={}: I expected {}, I got {}: {}'.format(
-                    pk, expected_value, type(exception), exception
-                )
-            )
+        calc, actual_value = processes.get(pk, (None, None))
+        if actual_value is None:
+            reason = 'the workchain does not exist' if calc is None else 'the workchain has no `output` output'
+            print(f'* UNABLE TO RETRIEVE VALUE for workchain pk={pk}: I expected {expected_value}, but {reason}')
             valid = False
             this_valid = False
-            actual_value = None
 
         # I check only if this_valid, otherwise calc could not exist
         if this_valid and not calc.is_finished_ok:
@@ -195,9 +262,27 @@ def validate_workchains(expected_results):
     return valid
 
 
-def validate_cached(cached_calcs):
-    """Check that the calculations with created with caching are indeed cached."""
+def validate_cached(cached_pks):
+    """Check that the calculations with created with caching are indeed cached.
+
+    The cached calculations and the calculations they were cached from are each loaded with a single query.
+    """
     valid = True
+    query = QueryBuilder().append(ProcessNode, filters={'id': {'in': cached_pks}})
+    cached_calcs = query.all(flat=True)
+    source_uuids = [calc.base.extras.get(NodeCaching.CACHED_FROM_KEY) for calc in cached_calcs]
+    source_uuids = [uuid for uuid in source_uuids if uuid]
+    original_calcs = {}
+
+    if source_uuids:
+        query = QueryBuilder().append(ProcessNode, filters={'uuid': {'in': source_uuids}}, project=['uuid', '*'])
+        original_calcs = dict(query.all())
+
+    missing = set(cached_pks).difference(calc.pk for calc in cached_calcs)
+    if missing:
+        print(f'Cached calculations {sorted(missing)} do not exist')
+        valid = False
+
     for calc in cached_calcs:
         if not calc.is_finished_ok:
             print(
@@ -216,9 +301,14 @@ def validate_cached(cached_calcs):
             valid = False
 
         if isinstance(calc, CalcJobNode):
-            original_calc = load_node(calc.base.extras.get(NodeCaching.CACHED_FROM_KEY))
-            files_original = original_calc.base.repository.list_object_names()
-            files_cached = calc.base.repository.list_object_names()
+            original_calc = original_calcs.get(calc.base.extras.get(NodeCaching.CACHED_FROM_KEY))
+            if original_calc is None:
+                print(f'Could not retrieve the calculation that cached calculation<{calc.pk}> was cached from')
+                valid = False
+                continue
+
+            files_original = set(original_calc.base.repository.list_object_names())
+            files_cached = set(calc.base.repository.list_object_names())
 
             if not files_cached:
                 print(f'Cached calculation <{calc.pk}> does not have any raw inputs files')
@@ -232,10 +322,10 @@ def validate_cached(cached_calcs):
                 )
                 valid = False
 
-            if set(files_original) != set(files_cached):
+            if files_original != files_cached:
                 print(
                     'different raw input files [{}] vs [{}] for original<{}> and cached<{}> calculation'.format(
-                        set(files_original), set(files_cached), original_calc.pk, calc.pk
+                        files_original, files_cached, original_calc.pk, calc.pk
                     )
                 )
                 valid = False
@@ -278,18 +368,13 @@ def launch_calculation(code, counter, inputval):
     return calc, expected_result
 
 
-def run_calculation(code, counter, inputval):
-    """Run a calculation through the Process layer."""
-    process, inputs, expected_result = create_calculation_process(code=code, inputval=inputval)
-    _, calc = run.get_node(process, **inputs)
-    print(f'[{counter}] ran calculation {calc.uuid}, pk={calc.pk}')
-    return calc, expected_result
-
+@functools.lru_cache(maxsize=None)
+def get_template():
+    """Return the stored template for the calculations.
 
-def create_calculation_process(code, inputval):
-    """Create the process and inputs for a submitting / running a calculation."""
-    parameters = Dict({'value': inputval})
-    template = Dict(
+    The template is identical for all calculations, so a single node is created and shared by all of them.
+    """
+    return Dict(
         {
             # The following line adds a significant sleep time.
             # I set it to 1 second to speed up tests
@@ -303,7 +388,13 @@ def create_calculation_process(code, inputval):
             'output_file_name': 'output.txt',
             'retrieve_temporary_files': ['triple_value.tmp'],
         }
-    )
+    ).store()
+
+
+def create_calculation_process(code, inputval):
+    """Create the process and inputs for a submitting / running a calculation."""
+    parameters = Dict({'value': inputval})
+    template = get_template()
     options = {
         'resources': {'num_machines': 1},
         'max_wallclock_seconds': 5 * 60,
@@ -321,7 +412,7 @@ def create_calculation_process(code, inputval):
             'options': options,
         },
     }
-    return CalculationFactory('core.templatereplacer'), inputs, expected_result
+    return TemplatereplacerCalculation, inputs, expected_result
 
 
 def run_arithmetic_add():
@@ -414,15 +505,15 @@ def run_monitored_calculation():
     assert node.exit_message == 'Detected a non-empty submission script', node.exit_message
 
 
-def launch_all():
+def launch_all(code_doubler):
     """Launch a bunch of calculation jobs and workchains.
 
+    :param code_doubler: the code to use for the calculations.
     :returns: dictionary with expected results and pks of all launched calculations and workchains
     """
     expected_results_process_functions = {}
     expected_results_calculations = {}
     expected_results_workchains = {}
-    code_doubler = load_code(CODENAME_DOUBLER)
 
     # Run the `ArithmeticAddCalculation`
     print('Running the `ArithmeticAddCalculation`')
@@ -547,21 +638,128 @@ def launch_all():
     }
 
 
-def relaunch_cached(results):
-    """Launch the same calculations but with caching enabled -- these should be FINISHED immediately."""
-    code_doubler = load_code(CODENAME_DOUBLER)
-    cached_calcs = []
+def start_debug_commands():
+    """Start the ``verdi`` commands that print debug information as background processes.
+
+    The output is redirected to temporary files rather than pipes, such that the commands cannot block on a full pipe.
+
+    :return: list of tuples of the command, its process and the file that its output is written to.
+    """
+    debug_processes = []
+    for command in DEBUG_COMMANDS:
+        handle = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stdout=handle, stderr=subprocess.STDOUT)
+        debug_processes.append((command, process, handle))
+    return debug_processes
+
+
+def print_finished_debug_commands(debug_processes):
+    """Print the output of the debug commands that have finished, without waiting for those that are still running.
+
+    :param debug_processes: list of debug commands as returned by :func:`start_debug_commands`.
+    :return: list of the debug commands that are still running.
+    """
+    running = []
+    for command, process, handle in debug_processes:
+        if process.poll() is None:
+            running.append((command, process, handle))
+            continue
+
+        print(f"Output of '{' '.join(command)}':")
+        with handle:
+            handle.seek(0)
+            print(handle.read().decode(errors='replace'))
+        if process.returncode:
+            print(f'Note: the command failed with exit status {process.returncode}')
+
+    return running
+
+
+async def wait_for_processes(pks, debug=False):
+    """Wait until all processes with the given pks have terminated.
+
+    Instead of polling at a fixed interval, this waits on futures that resolve as soon as the termination of the
+    process is broadcast. Every ``REPORT_INTERVAL`` seconds some progress information is printed, both for debugging
+    reasons and to avoid that the test machine is shut down because there is no output. The process states are then
+    also queried, as a fail-safe should a termination broadcast be missed.
+
+    :param pks: the pks of the processes to wait for.
+    :param debug: if True, also print the output of ``verdi process list`` and ``verdi daemon status``. These are run in
+        the background at most every ``DEBUG_INTERVAL`` seconds, such that they never block the wait.
+    """
+    runner = get_manager().get_runner()
+    start_time = time.time()
+    terminated = set()
+    debug_processes = []
+    debug_time = None
+    futures = asyncio.gather(*[ProcessFuture(pk, runner.loop, None, runner.communicator) for pk in pks])
+
+    try:
+        while True:
+            done, _ = await asyncio.wait([futures], timeout=REPORT_INTERVAL)
+
+            print('#' * 78)
+            print(f'####### TIME ELAPSED: {time.time() - start_time} s')
+            print('#' * 78)
+            if debug:
+                debug_processes = print_finished_debug_commands(debug_processes)
+
+            if done or jobs_have_finished(pks, terminated):
+                return
+
+            if debug and not debug_processes and (debug_time is None or time.time() - debug_time >= DEBUG_INTERVAL):
+                debug_processes = start_debug_commands()
+                debug_time = time.time()
+    finally:
+        futures.cancel()
+        for _, process, handle in print_finished_debug_commands(debug_processes):
+            process.kill()
+            process.wait()
+            handle.close()
+
+
+def wait_for_processes_or_exit(pks, debug=False):
+    """Block until all processes with the given pks have terminated, exiting if this takes more than ``TIMEOUTSECS``.
+
+    :param pks: the pks of the processes to wait for.
+    :param debug: if True, also print the output of ``verdi process list`` and ``verdi daemon status``.
+    """
+    try:
+        get_manager().get_runner().run_until_complete(
+            asyncio.wait_for(wait_for_processes(pks, debug=debug), TIMEOUTSECS)
+        )
+    except asyncio.TimeoutError:
+        print_daemon_log()
+        print('')
+        print(f'Timeout!! Calculation did not complete after {TIMEOUTSECS} seconds')
+        sys.exit(2)
+
+
+def relaunch_cached(results, code_doubler, debug=False):
+    """Launch the same calculations but with caching enabled, then validate the results of all processes.
+
+    The calculations are submitted to the daemon and awaited. They should be taken from the cache, so they do not have
+    to be run again, but they still go through the daemon before they are finished.
+
+    :param results: dictionary with expected results and pks as returned by :func:`launch_all`.
+    :param code_doubler: the code to use for the calculations.
+    :param debug: if True, print debug information while waiting for the calculations, see :func:`wait_for_processes`.
+    """
+    cached_pks = []
     with enable_caching(identifier='aiida.calculations:core.templatereplacer'):
         for counter in range(1, NUMBER_CALCULATIONS + 1):
             inputval = counter
-            calc, expected_result = run_calculation(code=code_doubler, counter=counter, inputval=inputval)
-            cached_calcs.append(calc)
+            calc, expected_result = launch_calculation(code=code_doubler, counter=counter, inputval=inputval)
+            cached_pks.append(calc.pk)
             results['calculations'][calc.pk] = expected_result
 
+    print('Waiting for end of execution of cached calculations...')
+    wait_for_processes_or_exit(cached_pks, debug=debug)
+
     if not (
         validate_calculations(results['calculations'])
         and validate_workchains(results['workchains'])
-        and validate_cached(cached_calcs)
+        and validate_cached(cached_pks)
         and validate_process_functions(results['process_functions'])
     ):
         print_daemon_log()
@@ -575,55 +773,19 @@ def relaunch_cached(results):
 
 
 def main():
-    """Launch a bunch of calculation jobs and workchains."""
-    results = launch_all()
-
-    print('Waiting for end of execution...')
-    start_time = time.time()
-    exited_with_timeout = True
-    while time.time() - start_time < TIMEOUTSECS:
-        time.sleep(15)  # Wait a few seconds
-
-        # Print some debug info, both for debugging reasons and to avoid
-        # that the test machine is shut down because there is no output
-
-        print('#' * 78)
-        print(f'####### TIME ELAPSED: {time.time() - start_time} s')
-        print('#' * 78)
-        print("Output of 'verdi process list -a':")
-        try:
-            print(
-                subprocess.check_output(
-                    ['verdi', 'process', 'list', '-a'],
-                    stderr=subprocess.STDOUT,
-                )
-            )
-        except subprocess.CalledProcessError as exception:
-            print(f'Note: the command failed, message: {exception}')
-
-        print("Output of 'verdi daemon status':")
-        try:
-            print(
-                subprocess.check_output(
-                    ['verdi', 'daemon', 'status'],
-                    stderr=subprocess.STDOUT,
-                )
-            )
-        except subprocess.CalledProcessError as exception:
-            print(f'Note: the command failed, message: {exception}')
+    """Launch a bunch of calculation jobs and workchains.
 
-        if jobs_have_finished(results['pks']):
-            print('Calculation terminated its execution')
-            exited_with_timeout = False
-            break
+    Pass ``--debug`` to print the output of some ``verdi`` commands while waiting for the processes to terminate.
+    """
+    debug = '--debug' in sys.argv[1:]
+    code_doubler = load_code(CODENAME_DOUBLER)
+    results = launch_all(code_doubler)
 
-    if exited_with_timeout:
-        print_daemon_log()
-        print('')
-        print(f'Timeout!! Calculation did not complete after {TIMEOUTSECS} seconds')
-        sys.exit(2)
+    print('Waiting for end of execution...')
+    wait_for_processes_or_exit(results['pks'], debug=debug)
+    print('Calculation terminated its execution')
 
-    relaunch_cached(results)
+    relaunch_cached(results, code_doubler, debug=debug)
 
     # Check that no references to processes remain in memory
     # Note: This tests only processes that were `run` in the same interpreter, not those that were `submitted`